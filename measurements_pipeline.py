@@ -1,9 +1,13 @@
-from pandas import read_csv, DataFrame, to_datetime, to_numeric
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime, timedelta
+from pandas import read_csv, read_parquet, concat, DataFrame, to_datetime, to_numeric
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from apscheduler.schedulers.blocking import BlockingScheduler
+from datetime import datetime
+from typing import Callable, Optional
 import logging
-import time
-import atexit
+import os
+import signal
 
 # Configure logging once for the module with UTF-8 encoding for emojis
 logging.basicConfig(
@@ -17,14 +21,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global DataFrame to hold the measurements
-measurements_data = DataFrame()
+# (mtime, size) of the input CSV when it was last processed, used to skip unchanged cycles
+last_input_signature = None
+
+# Number of CSV rows parsed per chunk while loading
+CSV_CHUNKSIZE = 500_000
+
+# Parquet copy of the cleaned dataset, reused while the input CSV is unchanged
+DATASET_CACHE_FILENAME = 'measurements.parquet'
+
+# Range of the compact integer dtype used for cleaned measurement columns
+INT32_INFO = np.iinfo(np.int32)
+
+# Input columns the pipeline drops anyway, so the scheduled job never parses them
+UNUSED_COLUMNS = {'date'}
 
 # First Stage: Loading the dataset
-def load_dataset(filename: str, delimiter: str = ';') -> DataFrame:
-    """Load dataset from a CSV file."""
+def load_dataset(filename: str, delimiter: str = ';', chunksize: int = CSV_CHUNKSIZE, usecols: Optional[Callable[[str], bool]] = None) -> DataFrame:
+    """Load dataset from a CSV file in chunks, dropping the Dev test rows as they are read."""
     try:
-        df = read_csv(filename, delimiter=delimiter)
+        # Read the measurement columns as text so every chunk gets the same dtype;
+        # cleaning coerces them to numbers and tolerates malformed cells
+        chunks = read_csv(
+            filename,
+            delimiter=delimiter,
+            chunksize=chunksize,
+            usecols=usecols,
+            dtype={'grid_purchase': str, 'grid_feedin': str, 'direct_consumption': str}
+        )
+        df = concat(
+            (chunk[chunk['direct_consumption'] != 'Dev test'] if 'direct_consumption' in chunk.columns else chunk for chunk in chunks),
+            ignore_index=True
+        )
         logger.info("✅ Loaded dataset with %s rows and %s columns.", df.shape[0], df.shape[1])
         return df
 
@@ -36,9 +64,54 @@ def load_dataset(filename: str, delimiter: str = ';') -> DataFrame:
         logger.exception("❌ An error occurred while loading dataset")
         return DataFrame()
 
+def get_file_signature(filename: str):
+    """Return the (mtime, size) of a file, or None if it cannot be read."""
+    try:
+        stat = os.stat(filename)
+        return stat.st_mtime, stat.st_size
+    except OSError:
+        return None
+
+def load_cleaned_dataset(filename: str, cache_filename: str, delimiter: str = ';', unused_columns=frozenset()) -> Optional[DataFrame]:
+    """Load and clean a dataset, reusing a Parquet copy of the cleaned frame while the CSV and column selection are unchanged.
+
+    Return None if cleaning failed.
+    """
+    key_filename = cache_filename + '.key'
+    signature = get_file_signature(filename)
+    if signature is None:
+        logger.error("❌ File not found: %s", filename)
+        return DataFrame()
+
+    # Key the cache on the file signature and the skipped columns, so a changed projection is re-parsed
+    cache_key = repr((signature, sorted(unused_columns)))
+    try:
+        if os.path.exists(cache_filename) and os.path.exists(key_filename):
+            with open(key_filename, encoding='utf-8') as f:
+                cached_key = f.read()
+            if cached_key == cache_key:
+                df = read_parquet(cache_filename, engine='pyarrow')
+                logger.info("✅ Loaded cached cleaned dataset with %s rows and %s columns.", df.shape[0], df.shape[1])
+                return df
+    except Exception as e:
+        logger.exception("❌ An error occurred while reading cached dataset, re-parsing CSV")
+
+    df = load_dataset(filename, delimiter, usecols=lambda column: column not in unused_columns)
+    if df.empty:
+        return df
+    df = get_cleaned_dataset(df)
+    if df is not None and not df.empty:
+        try:
+            df.to_parquet(cache_filename, engine='pyarrow', index=True)
+            with open(key_filename, 'w', encoding='utf-8') as f:
+                f.write(cache_key)
+        except Exception as e:
+            logger.exception("❌ An error occurred while caching dataset")
+    return df
+
 # Second Stage: Cleaning the dataset
-def get_cleaned_dataset(df: DataFrame) -> DataFrame:
-    """Clean and preprocess raw measurement data."""
+def get_cleaned_dataset(df: DataFrame) -> Optional[DataFrame]:
+    """Clean and preprocess raw measurement data. Return None if cleaning failed."""
     try:
         if df.empty:
             logger.warning("⚠️  DataFrame is empty, skipping cleaning process.")
@@ -49,12 +122,22 @@ def get_cleaned_dataset(df: DataFrame) -> DataFrame:
             logger.error("❌ Missing required columns in dataset.")
             return DataFrame()
 
-        # Task #1: Remove the Dev test rows
-        df = df[df['direct_consumption'] != 'Dev test']
-
-        # Task #2: Convert columns to numeric, handling errors
-        for col in ['grid_purchase', 'grid_feedin', 'direct_consumption']:
-            df.loc[:, col] = to_numeric(df[col], errors='coerce').fillna(0).astype(int)
+        # Task #1: Remove the Dev test rows into an explicit copy so later column writes skip SettingWithCopy checks
+        df = df.loc[(df['direct_consumption'] != 'Dev test').to_numpy()].copy()
+
+        # Task #2: Convert columns to numeric, replacing nulls and invalid values with 0
+        numeric_columns = ['grid_purchase', 'grid_feedin', 'direct_consumption']
+        coerced = {
+            col: to_numeric(df[col], errors='coerce').fillna(0)
+            for col in numeric_columns
+        }
+        for col, values in coerced.items():
+            # Store as int32 to halve groupby bandwidth, keeping int64 for readings that would not fit
+            if values.empty or (values.min() >= INT32_INFO.min and values.max() <= INT32_INFO.max):
+                df[col] = values.astype('int32').values
+            else:
+                logger.warning("⚠️  Column %s has values outside the int32 range, keeping it as int64.", col)
+                df[col] = values.astype('int64').values
 
         # Task #3: Remove the redundant date column
         df = df.drop(columns=['date'], errors='ignore')
@@ -62,112 +145,122 @@ def get_cleaned_dataset(df: DataFrame) -> DataFrame:
         # Task #4: Convert the timestamp column to datetime
         df['timestamp'] = to_datetime(df['timestamp'], errors='coerce')
 
-        # Task #5: Drop rows where timestamp is missing before setting as index
-        df = df.dropna(subset=['timestamp']).set_index('timestamp')
-        df = df[~df.index.duplicated(keep='first')]
+        # Task #5: Drop rows where timestamp is missing or duplicated before setting as index
+        df = df.dropna(subset=['timestamp']).drop_duplicates(subset='timestamp', keep='first').set_index('timestamp')
 
-        # Task #6: Replace null values in selected columns with 0
-        df.loc[:, ['grid_purchase', 'grid_feedin']] = df[['grid_purchase', 'grid_feedin']].fillna(0).copy()
+        # Task #6: Add a flag column to indicate where direct_consumption is greater than zero
+        df['direct_consumption_flag'] = np.greater(df['direct_consumption'].values, 0)
 
-        # Task #7: Add a flag column to indicate where direct_consumption is greater than zero
-        df['direct_consumption_flag'] = df['direct_consumption'] > 0
+        # Task #7: Sort chronologically once so later stages work on monotonic day keys
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
 
         return df
 
     except Exception as e:
         logger.exception("❌ An error occurred while cleaning")
-        return df
+        return None
 
-def add_hour_metrics(df: DataFrame) -> DataFrame:
-    """Add hourly aggregated metrics to DataFrame."""
+def add_hour_metrics(df: DataFrame) -> Optional[DataFrame]:
+    """Add hourly aggregated metrics to DataFrame. Return None if the metrics could not be computed."""
     try:
         if df.empty:
             logger.warning("⚠️  DataFrame is empty, skipping hour metrics.")
             return df
 
-        df['hour'] = df.index.hour
-        hourly_totals = df.groupby('hour')[['grid_purchase', 'grid_feedin']].sum()
-        hourly_totals.columns = [col + '_total' for col in hourly_totals.columns]
-
-        df = df.join(hourly_totals, on='hour', how='left')
-        df = df.drop(columns=['hour'])
+        # Broadcast the 24 hourly totals back to the rows by indexing with the hour
+        hours = df.index.hour.values.astype(np.intp)
+        gp_totals = np.bincount(hours, weights=df['grid_purchase'].values, minlength=24).astype('int64')
+        gf_totals = np.bincount(hours, weights=df['grid_feedin'].values, minlength=24).astype('int64')
+        df['grid_purchase_total'] = gp_totals[hours]
+        df['grid_feedin_total'] = gf_totals[hours]
 
         # Identify the hour with the maximum grid purchase and grid feed-in
-        df['max_grid_purchase_hour'] = df.groupby(df.index.floor('D'))['grid_purchase'].transform(lambda x: x == x.max())
-        df['max_grid_feedin_hour'] = df.groupby(df.index.floor('D'))['grid_feedin'].transform(lambda x: x == x.max())
+        day_key = df.index.floor('D').asi8
+        daily_max = df.groupby(day_key, sort=False)[['grid_purchase', 'grid_feedin']].transform('max')
+        df['max_grid_purchase_hour'] = np.equal(df['grid_purchase'].values, daily_max['grid_purchase'].values)
+        df['max_grid_feedin_hour'] = np.equal(df['grid_feedin'].values, daily_max['grid_feedin'].values)
 
         return df
 
     except Exception as e:
         logger.exception("❌ An error occurred while adding hour metrics")
-        return df
+        return None
 
 # Third Stage: Exporting the cleaned dataset
-def export_dataset(df: DataFrame, filename: str, delimiter: str = ',') -> None:
-    """Export DataFrame to CSV file."""
+def export_dataset(df: DataFrame, filename: str, delimiter: str = ',', use_arrow: bool = False) -> bool:
+    """Export DataFrame to a CSV file, or to Parquet when the filename ends with .parquet. Return whether a file was written."""
     try:
         if df.empty:
             logger.warning("⚠️  No data to export.")
-            return
-        df.to_csv(filename, sep=delimiter, index=True, encoding='utf-8')
+            return False
+        if filename.endswith('.parquet'):
+            df.to_parquet(filename, engine='pyarrow', compression='zstd', index=True)
+        elif use_arrow:
+            # Arrow's multithreaded writer is faster but formats headers, timestamps and booleans differently
+            table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+            pacsv.write_csv(table, filename, write_options=pacsv.WriteOptions(delimiter=delimiter))
+        else:
+            df.to_csv(filename, sep=delimiter, index=True, encoding='utf-8')
         logger.info("✅ Exported dataset with %s rows and %s columns.", df.shape[0], df.shape[1])
+        return True
 
     except Exception as e:
         logger.exception("❌ An error occurred while exporting")
+        return False
 
 # Fourth Stage: Scheduling the pipeline
-def load_dataset_job():
-    """Scheduled job to load dataset into global measurements_data."""
-    global measurements_data
-    measurements_data = load_dataset('measurements_coding_challenge.csv', ';')
-
-def get_cleaned_dataset_job():
-    """Scheduled job to clean global measurements_data in-place."""
-    global measurements_data
-    if measurements_data.empty:
-        logger.warning("⚠️  Skipping cleaning: No data loaded yet.")
+def run_pipeline_job(
+    input_filename: str = 'measurements_coding_challenge.csv',
+    output_filename: str = 'cleaned_measurements.csv',
+    cache_filename: str = DATASET_CACHE_FILENAME
+) -> None:
+    """Scheduled job to load, clean, add metrics to and export the dataset when the input CSV changed."""
+    global last_input_signature
+    signature = get_file_signature(input_filename)
+    if signature is not None and signature == last_input_signature:
+        logger.info("⏭️  Input file unchanged, skipping pipeline cycle.")
         return
-    measurements_data = get_cleaned_dataset(measurements_data)
 
-def add_hour_metrics_job():
-    """Scheduled job to add hourly metrics to global measurements_data in-place."""
-    global measurements_data
-    if measurements_data.empty:
-        logger.warning("⚠️  Skipping hour metrics: No data available.")
+    # Only mark the input as processed once every stage succeeded and the result is exported
+    df = load_cleaned_dataset(input_filename, cache_filename, ';', unused_columns=UNUSED_COLUMNS)
+    if df is None:
+        logger.warning("⚠️  Cleaning failed, retrying next cycle.")
         return
-    measurements_data = add_hour_metrics(measurements_data)
-
-def export_dataset_job():
-    """Scheduled job to export global measurements_data to a CSV file."""
-    global measurements_data
-    if measurements_data.empty:
-        logger.warning("⚠️  Skipping export: No data available.")
+    if df.empty:
+        logger.warning("⚠️  Skipping pipeline cycle: No data to process.")
         return
-    export_dataset(measurements_data, 'cleaned_measurements.csv', ',')
+    df = add_hour_metrics(df)
+    if df is None:
+        logger.warning("⚠️  Adding hour metrics failed, retrying next cycle.")
+        return
+    if not export_dataset(df, output_filename, ','):
+        logger.warning("⚠️  Export failed, retrying next cycle.")
+        return
+    last_input_signature = signature
 
 scheduler_instance = None
 
 def schedule_pipeline() -> None:
-    """Initialize and start the scheduled pipeline jobs."""
+    """Initialize the scheduled pipeline job and run the scheduler in the calling thread until stopped."""
     global scheduler_instance
     if scheduler_instance is not None:
         logger.warning("⚠️  Scheduler is already running. Skipping duplicate scheduling.")
         return
 
-    scheduler_instance = BackgroundScheduler()
-    scheduler_instance.add_job(load_dataset_job, 'interval', minutes=5, next_run_time=datetime.now())
-    scheduler_instance.add_job(get_cleaned_dataset_job, 'interval', minutes=5, next_run_time=datetime.now() + timedelta(seconds=10))
-    scheduler_instance.add_job(add_hour_metrics_job, 'interval', minutes=5, next_run_time=datetime.now() + timedelta(seconds=15))
-    scheduler_instance.add_job(export_dataset_job, 'interval', minutes=5, next_run_time=datetime.now() + timedelta(seconds=20))
+    scheduler_instance = BlockingScheduler()
+    scheduler_instance.add_job(run_pipeline_job, 'interval', minutes=5, next_run_time=datetime.now(), max_instances=1, coalesce=True)
 
-    scheduler_instance.start()
-    logger.info("🚀 Pipeline scheduler started.")
+    # Stop the scheduler on SIGTERM (e.g. docker stop), which makes start() return
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler_instance.shutdown(wait=False))
 
-    # Shut down the scheduler when exiting the script
-    atexit.register(lambda: scheduler_instance.shutdown())
+    logger.info("🚀 Pipeline scheduler started.")
+    try:
+        scheduler_instance.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    logger.info("🛑 Pipeline scheduler stopped.")
 
 # Run the pipeline
 if __name__ == '__main__':
-    while True:
-        schedule_pipeline()
-        time.sleep(60)
+    schedule_pipeline()
@@ -1,13 +1,18 @@
 import unittest
+from unittest import mock
 import pandas as pd
 import os
 import logging
+import shutil
 from pandas import DataFrame
+import measurements_pipeline
 from measurements_pipeline import (
     load_dataset,
+    load_cleaned_dataset,
     get_cleaned_dataset,
     add_hour_metrics,
     export_dataset,
+    run_pipeline_job,
 )
 
 # Configure logging for unit tests with UTF-8 encoding for emojis
@@ -61,10 +66,92 @@ class TestMeasurementPipeline(unittest.TestCase):
         self.assertEqual(df.shape[0], 3, "DataFrame should have 3 rows.")
         self.assertEqual(df.shape[1], 5, "DataFrame should have 5 columns.")
 
+        # Test skipping unused columns while parsing
+        df_projected = load_dataset(self.test_filename, delimiter=';', usecols=lambda column: column != 'date')
+        self.assertNotIn("date", df_projected.columns, "Skipped columns should not be loaded.")
+        self.assertEqual(df_projected.shape, (3, 4), "DataFrame should have 3 rows and 4 columns.")
+
         # Test loading a non-existent file
         df_nonexistent = load_dataset("nonexistent.csv")
         self.assertTrue(df_nonexistent.empty, "DataFrame should be empty for nonexistent file.")
 
+    def test_load_dataset_in_chunks(self):
+        """Test that chunked loading keeps all rows and drops the Dev test rows."""
+        df = load_dataset(self.test_filename, delimiter=';', chunksize=1)
+        self.assertEqual(df.shape, (3, 5), "Chunked loading should match a single read.")
+
+        dev_test_filename = "test_dev_test.csv"
+        dev_test_df = self.sample_df.astype({"direct_consumption": str})
+        dev_test_df.loc[1, "direct_consumption"] = "Dev test"
+        dev_test_df.to_csv(dev_test_filename, index=False, sep=';')
+        try:
+            df = load_dataset(dev_test_filename, delimiter=';', chunksize=2)
+            self.assertEqual(len(df), 2, "Dev test rows should be dropped while loading.")
+        finally:
+            os.remove(dev_test_filename)
+
+    def test_malformed_grid_values(self):
+        """Test that malformed grid cells are coerced to 0 instead of failing the load."""
+        malformed_filename = "test_malformed_data.csv"
+        malformed_df = self.sample_df.astype({"grid_purchase": str})
+        malformed_df.loc[1, "grid_purchase"] = "err"
+        malformed_df.loc[2, "grid_purchase"] = "16777217"
+        malformed_df = malformed_df.astype({"grid_feedin": str})
+        malformed_df.loc[2, "grid_feedin"] = "3000000000"
+        malformed_df.to_csv(malformed_filename, index=False, sep=';')
+        try:
+            df = load_dataset(malformed_filename, delimiter=';')
+            self.assertEqual(len(df), 3, "A malformed cell should not drop the dataset.")
+
+            cleaned_df = get_cleaned_dataset(df)
+            self.assertEqual(cleaned_df["grid_purchase"].tolist(), [100, 0, 16777217], "Malformed cells should become 0 and large values stay exact.")
+            self.assertEqual(cleaned_df["grid_feedin"].tolist(), [10, 20, 3000000000], "Values above the int32 range should not wrap.")
+            self.assertEqual(cleaned_df["grid_purchase"].dtype, "int32", "Columns within range should be stored as int32.")
+        finally:
+            os.remove(malformed_filename)
+
+        # A file without a timestamp column still loads and is rejected by cleaning
+        no_timestamp_filename = "test_no_timestamp.csv"
+        self.sample_df.drop(columns=["timestamp"]).to_csv(no_timestamp_filename, index=False, sep=';')
+        try:
+            df = load_dataset(no_timestamp_filename, delimiter=';')
+            self.assertEqual(len(df), 3, "Loading should not depend on the timestamp column.")
+            self.assertTrue(get_cleaned_dataset(df).empty, "Cleaning should reject a dataset without timestamps.")
+        finally:
+            os.remove(no_timestamp_filename)
+
+    def test_load_cleaned_dataset(self):
+        """Test that the cleaned Parquet cache is reused until the CSV changes."""
+        csv_filename = "test_cached_data.csv"
+        cache_filename = "test_cached_data.parquet"
+        self.sample_df.to_csv(csv_filename, index=False, sep=';')
+        try:
+            df = load_cleaned_dataset(csv_filename, cache_filename, delimiter=';')
+            self.assertTrue(os.path.exists(cache_filename), "Parquet cache should be written on first load.")
+            self.assertIsInstance(df.index, pd.DatetimeIndex, "Cached frame should be indexed by timestamp.")
+            self.assertEqual(df['grid_purchase'].dtype, 'int32', "Cached frame should hold the cleaned dtypes.")
+
+            # A cache hit skips both parsing and cleaning
+            with self.assertLogs(measurements_pipeline.logger, level='INFO') as logs:
+                df_cached = load_cleaned_dataset(csv_filename, cache_filename, delimiter=';')
+            self.assertTrue(any("cached" in line for line in logs.output), "Second load should be served from cache.")
+            pd.testing.assert_frame_equal(df_cached, df)
+
+            # A different column selection must not be served from the cache
+            with self.assertLogs(measurements_pipeline.logger, level='INFO') as logs:
+                load_cleaned_dataset(csv_filename, cache_filename, delimiter=';', unused_columns={'date'})
+            self.assertTrue(any("Loaded dataset with" in line for line in logs.output), "A changed projection should be re-parsed instead of read from cache.")
+
+            # Touch the CSV with new content so the cache is invalidated
+            self.sample_df.head(2).to_csv(csv_filename, index=False, sep=';')
+            os.utime(csv_filename, (0, 0))
+            df = load_cleaned_dataset(csv_filename, cache_filename, delimiter=';')
+            self.assertEqual(len(df), 2, "A changed CSV should be re-parsed instead of read from cache.")
+        finally:
+            for filename in (csv_filename, cache_filename, cache_filename + '.key'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
     def test_get_cleaned_dataset(self):
         """Test cleaning the dataset."""
         df = load_dataset(self.test_filename, delimiter=';')
@@ -106,6 +193,28 @@ class TestMeasurementPipeline(unittest.TestCase):
         empty_df = add_hour_metrics(DataFrame())
         self.assertTrue(empty_df.empty, "Adding hour metrics on an empty DataFrame should return an empty DataFrame.")
 
+    def test_hourly_totals(self):
+        """Test that hourly totals sum readings sharing the same hour across days."""
+        data = {
+            "timestamp": ["2023-10-01 00:00:00", "2023-10-01 01:00:00", "2023-10-02 00:30:00"],
+            "grid_purchase": [100, 200, 300],
+            "grid_feedin": [10, 20, 30],
+            "direct_consumption": [50, 60, 70],
+        }
+        df_with_metrics = add_hour_metrics(get_cleaned_dataset(pd.DataFrame(data)))
+
+        self.assertEqual(df_with_metrics["grid_purchase_total"].tolist(), [400, 200, 400], "grid_purchase_total should sum per hour of day.")
+        self.assertEqual(df_with_metrics["grid_feedin_total"].tolist(), [40, 20, 40], "grid_feedin_total should sum per hour of day.")
+
+    def test_max_hour_flags(self):
+        """Test that the daily maximum rows are flagged."""
+        df = load_dataset(self.test_filename, delimiter=';')
+        df_with_metrics = add_hour_metrics(get_cleaned_dataset(df))
+
+        # The last sample has the highest purchase and feed-in of the day
+        self.assertEqual(df_with_metrics["max_grid_purchase_hour"].tolist(), [False, False, True], "Only the daily max grid_purchase should be flagged.")
+        self.assertEqual(df_with_metrics["max_grid_feedin_hour"].tolist(), [False, False, True], "Only the daily max grid_feedin should be flagged.")
+
     def test_export_dataset(self):
         """Test exporting the dataset."""
         df = load_dataset(self.test_filename, delimiter=';')
@@ -121,10 +230,83 @@ class TestMeasurementPipeline(unittest.TestCase):
         self.assertEqual(exported_df.shape[0], df_with_metrics.shape[0], "Exported DataFrame row count should match.")
         self.assertEqual(exported_df.shape[1], df_with_metrics.shape[1], "Exported DataFrame column count should match.")
 
+        # Check the text format of the default CSV export
+        with open(self.export_filename, encoding='utf-8') as f:
+            header, first_row = f.readline().rstrip('\n'), f.readline().rstrip('\n')
+        self.assertEqual(header, "timestamp,grid_purchase,grid_feedin,direct_consumption,direct_consumption_flag,grid_purchase_total,grid_feedin_total,max_grid_purchase_hour,max_grid_feedin_hour", "Header should be unquoted with timestamp first.")
+        self.assertEqual(first_row, "2023-10-01 00:00:00,100,10,50,True,100,10,False,False", "Timestamps and booleans should keep pandas' text format.")
+
         # Test exporting empty DataFrame
         export_dataset(DataFrame(), "empty_export.csv")
         self.assertFalse(os.path.exists("empty_export.csv"), "Empty DataFrame should not produce an export file.")
 
+    def test_export_dataset_arrow(self):
+        """Test the opt-in Arrow CSV writer."""
+        df = load_dataset(self.test_filename, delimiter=';')
+        df_with_metrics = add_hour_metrics(get_cleaned_dataset(df))
+
+        arrow_filename = "test_export_arrow.csv"
+        try:
+            export_dataset(df_with_metrics, arrow_filename, use_arrow=True)
+            exported_df = pd.read_csv(arrow_filename, index_col='timestamp', parse_dates=True)
+            self.assertEqual(exported_df.shape, df_with_metrics.shape, "Arrow export should keep all rows and columns.")
+            self.assertEqual(exported_df["grid_purchase"].tolist(), df_with_metrics["grid_purchase"].tolist(), "Arrow export should keep the values.")
+        finally:
+            if os.path.exists(arrow_filename):
+                os.remove(arrow_filename)
+
+    def test_export_dataset_parquet(self):
+        """Test exporting the dataset to Parquet."""
+        df = load_dataset(self.test_filename, delimiter=';')
+        df_with_metrics = add_hour_metrics(get_cleaned_dataset(df))
+
+        parquet_filename = "test_export.parquet"
+        try:
+            export_dataset(df_with_metrics, parquet_filename)
+            exported_df = pd.read_parquet(parquet_filename)
+            pd.testing.assert_frame_equal(exported_df, df_with_metrics)
+        finally:
+            if os.path.exists(parquet_filename):
+                os.remove(parquet_filename)
+
+    def test_run_pipeline_job_retries_failed_export(self):
+        """Test that an unchanged input is skipped only after a successful export."""
+        cache_filename = "test_pipeline_cache.parquet"
+        output_dir = "test_pipeline_output"
+        output_filename = os.path.join(output_dir, "cleaned.csv")
+        measurements_pipeline.last_input_signature = None
+        os.makedirs(output_dir)
+        try:
+            # Cleaning fails after the index is set, so nothing is exported and the input is retried
+            with mock.patch.object(measurements_pipeline.np, 'greater', side_effect=RuntimeError("boom")):
+                self.assertIsNone(get_cleaned_dataset(load_dataset(self.test_filename, delimiter=';')), "A failed cleaning should return None.")
+                run_pipeline_job(self.test_filename, output_filename, cache_filename)
+            self.assertFalse(os.path.exists(output_filename), "A partly cleaned dataset should not be exported.")
+            self.assertIsNone(measurements_pipeline.last_input_signature, "A failed stage should not mark the input as processed.")
+            shutil.rmtree(output_dir)
+
+            # The output directory does not exist yet, so the export fails
+            run_pipeline_job(self.test_filename, output_filename, cache_filename)
+            self.assertIsNone(measurements_pipeline.last_input_signature, "A failed export should not mark the input as processed.")
+
+            # The same unchanged input is retried on the next cycle
+            os.makedirs(output_dir)
+            run_pipeline_job(self.test_filename, output_filename, cache_filename)
+            self.assertTrue(os.path.exists(output_filename), "The retried cycle should export the dataset.")
+
+            # Once exported, an unchanged input is skipped
+            os.remove(output_filename)
+            with self.assertLogs(measurements_pipeline.logger, level='INFO') as logs:
+                run_pipeline_job(self.test_filename, output_filename, cache_filename)
+            self.assertFalse(os.path.exists(output_filename), "An unchanged input should not be exported again.")
+            self.assertTrue(any("unchanged" in line for line in logs.output), "Skipping should be logged.")
+        finally:
+            measurements_pipeline.last_input_signature = None
+            shutil.rmtree(output_dir, ignore_errors=True)
+            for filename in (cache_filename, cache_filename + '.key'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
     def test_duplicate_timestamps(self):
         """Test handling of duplicate timestamps."""
         duplicate_data = {
@@ -139,6 +321,19 @@ class TestMeasurementPipeline(unittest.TestCase):
         # Check if duplicates are removed
         self.assertEqual(len(cleaned_df), 2, "There should be only 2 unique timestamps after cleaning.")
 
+    def test_cleaned_dataset_is_sorted(self):
+        """Test that cleaning returns rows in chronological order."""
+        unsorted_data = {
+            "timestamp": ["2023-10-01 02:00:00", "2023-10-01 00:00:00", "2023-10-01 01:00:00"],
+            "grid_purchase": [100, 200, 300],
+            "grid_feedin": [10, 20, 30],
+            "direct_consumption": [50, 60, 70],
+        }
+        cleaned_df = get_cleaned_dataset(pd.DataFrame(unsorted_data))
+
+        self.assertTrue(cleaned_df.index.is_monotonic_increasing, "Cleaned DataFrame should be sorted by timestamp.")
+        self.assertEqual(cleaned_df["grid_purchase"].tolist(), [200, 300, 100], "Rows should move with their timestamps.")
+
     def test_missing_timestamps(self):
         """Test handling of missing timestamps."""
         missing_data = {